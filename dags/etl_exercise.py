@@ -1,17 +1,76 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 
 from airflow.decorators import dag, task
 import pandas as pd # DAG and task decorators for interfacing with the TaskFlow API
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 
+import io
 import os
+import shutil
 
 from psycopg2 import IntegrityError
+from sqlalchemy import Float
 
 import helpers as H
 from plotting import generate_time_series_report
 from airflow.providers.postgres.hooks.postgres import PostgresHook
 
+# Intermediate frames are exchanged between tasks as Parquet files under a run-scoped
+# folder, so only the file path travels through XCom. The folder is a volume mounted in
+# every Airflow container, so tasks of the same run can execute on different workers
+STAGING_DIR = '/opt/airflow/staging'
+# Staged files of runs that didn't succeed are kept this long, so their failed tasks can
+# still be cleared and retried
+STAGING_RETENTION = timedelta(days=7)
+
+
+def staging_path(run_id: str, name: str) -> str:
+    """
+    Builds the path of a staged Parquet file for the given DAG run, creating its folder if needed.
+    """
+    run_dir = os.path.join(STAGING_DIR, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    return os.path.join(run_dir, f'{name}.parquet')
+
+
+def write_staged(df: pd.DataFrame, path: str) -> str:
+    """
+    Writes a DataFrame as a staged Parquet file through a temporary file, so a failed attempt
+    never leaves a partial file behind that a retry could pick up.
+    """
+    tmp_path = f'{path}.tmp'
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, tmp_path, compression='zstd', use_dictionary=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def migrate_transactions_table(pg_hook: PostgresHook) -> None:
+    """
+    Adds the `run_id` column and its index to the transactions table when they are missing.
+    The catalog is checked first, so once the migration ran no DDL (and no table lock) is issued.
+    """
+    has_column, has_index = pg_hook.get_first(
+        """
+        SELECT
+            EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'transactions' AND column_name = 'run_id'
+            ),
+            EXISTS (
+                SELECT 1 FROM pg_indexes
+                WHERE schemaname = current_schema() AND indexname = 'transactions_run_id_idx'
+            )
+        """
+    )
+    if not has_column:
+        pg_hook.run("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS run_id TEXT")
+    if not has_index:
+        pg_hook.run("CREATE INDEX IF NOT EXISTS transactions_run_id_idx ON transactions (run_id)")
+
 
 @dag(
     # This defines how often your DAG will run, or the schedule by which your DAG runs. In this case, this DAG
@@ -20,7 +79,10 @@ from airflow.providers.postgres.hooks.postgres import PostgresHook
     # This DAG is set to run for the first time on January 1, 2021. Best practice is to use a static
     # start_date. Subsequent DAG runs are instantiated based on scheduler_interval
     start_date=datetime(2021, 1, 1),
-    max_active_runs=1,
+    # Staged files and reports are scoped per run, so several runs (e.g. when backfilling months)
+    # can be processed at the same time
+    max_active_runs=4,
+    max_active_tasks=4,
     # When catchup=False, your DAG will only run for the latest schedule_interval. In this case, this means
     # that tasks will not be run between January 1, 2021 and 30 mins ago. When turned on, this DAG's first
     # run will be for the next 30 mins, per the schedule_interval
@@ -32,29 +94,66 @@ from airflow.providers.postgres.hooks.postgres import PostgresHook
 def etl_exercise():
 
     @task()
-    def extract():
+    def extract(run_id=None):
         """
         Extracts raw transaction data from the data source.
 
         This function fetches or retrieves transaction data from an external data source 
-        (e.g., a file, database, API, etc.). The data is returned in a dictionary format
+        (e.g., a file, database, API, etc.). The data is staged as a Parquet file
         for further processing. It is usually the first step in an ETL pipeline.
 
+        Parameters
+        ----------
+        run_id : str
+            The identifier of the current DAG run, injected by Airflow and used to scope
+            the staged files.
+
         Returns
         -------
-        dict
-            A dictionary containing the raw transaction data with relevant keys (e.g., 
-            user_id, item_id, item_category, item_price, quantity, transaction_date).
+        str
+            The path of the Parquet file containing the raw transaction data with relevant
+            columns (e.g., user_id, item_id, item_category, item_price, quantity, transaction_date).
         """
         # Define the path to the data folder
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         DATA_DIR = os.path.join(BASE_DIR, 'data')
         CSV_FILE = os.path.join(DATA_DIR, 'transactions.csv')
-        df = pd.read_csv(CSV_FILE)
-        return df.to_dict()
+
+        # Low cardinality identifiers are dictionary encoded (read back as pandas categoricals),
+        # prices and quantities use 32 bits types and transaction_date is parsed as a timestamp
+        # while reading
+        category = pa.dictionary(pa.int32(), pa.string())
+        column_types = {
+            'user_id': category,
+            'item_id': category,
+            'item_category': category,
+            'item_price': pa.float32(),
+            'quantity': pa.int32(),
+            'transaction_date': pa.timestamp('s'),
+        }
+
+        # Reuse the staged file when it was already written by a previous attempt of this run
+        path = staging_path(run_id, 'extracted')
+        if os.path.exists(path):
+            logging.info(f"Reusing staged raw data at {path}")
+            return path
+
+        # Stream the CSV in blocks straight into Parquet row groups, so the whole file
+        # is never held in memory at once
+        tmp_path = f'{path}.tmp'
+        reader = pv.open_csv(
+            CSV_FILE,
+            read_options=pv.ReadOptions(block_size=64 << 20),
+            convert_options=pv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        )
+        with pq.ParquetWriter(tmp_path, reader.schema, compression='zstd') as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        os.replace(tmp_path, path)
+        return path
 
     @task() 
-    def cleansing_data(transactions_data: dict):
+    def cleansing_data(path: str, run_id=None):
         """
         Cleanses and preprocesses the raw transaction data.
 
@@ -64,32 +163,39 @@ def etl_exercise():
 
         Parameters
         ----------
-        transactions_data : dict
-            A dictionary containing raw transaction data. The keys typically include 
+        path : str
+            The path of the Parquet file containing raw transaction data. The columns typically include 
             'user_id', 'item_id', 'item_category', 'item_price', 'quantity', and 'transaction_date'.
+        run_id : str
+            The identifier of the current DAG run, injected by Airflow.
 
         Returns
         -------
-        dict
-            A cleaned version of the transaction data, where any invalid or missing values 
-            are handled, and the data is in the appropriate format for further processing.
+        str
+            The path of the Parquet file with the cleaned version of the transaction data, where any
+            invalid or missing values are handled, and the data is in the appropriate format for further processing.
         """
-        df = pd.DataFrame(transactions_data)
-        
-        # Drop missing values
-        df.dropna(inplace=True)
+        # Reuse the staged file when it was already written by a previous attempt of this run
+        cleansed_path = staging_path(run_id, 'cleansed')
+        if os.path.exists(cleansed_path):
+            logging.info(f"Reusing staged cleansed data at {cleansed_path}")
+            return cleansed_path
+
+        df = pd.read_parquet(path)
 
-        # Convert transaction_date to datetime
-        df['transaction_date'] = pd.to_datetime(df['transaction_date'])
+        # Drop missing values and apply outliers managements zscore over columns
+        # in a single row selection, so the frame is only materialized once
+        not_null = df.notna().all(axis=1).to_numpy()
+        df = H.remove_outliers_zscore(df, ['item_price', 'quantity'], where=not_null)
 
-        # Apply outliers managements zscore over columns
-        df = H.remove_outliers_zscore(df, 'item_price')
-        df = H.remove_outliers_zscore(df, 'quantity')
-        return df.to_dict()
+        # Restore the declared type of `quantity`, which is read back as float64 when the source has nulls
+        df = df.astype({'quantity': 'int32'})
+
+        return write_staged(df, cleansed_path)
 
 
     @task()
-    def transform_data(transactions_data: dict):
+    def transform_data(path: str):
         """
         Transforms the cleansed transaction data for further analysis or storage.
 
@@ -99,39 +205,28 @@ def etl_exercise():
 
         Parameters
         ----------
-        transactions_data : dict
-            A dictionary containing the cleansed transaction data.
+        path : str
+            The path of the Parquet file containing the cleansed transaction data.
 
         Returns
         -------
-        dict
-            A dictionary containing the transformed data, with additional calculated columns 
-            or grouped summaries for analysis or reporting.
+        None
+            The results of the analysis are logged, the transformed data is not handed over to
+            other tasks.
         """
-        df = pd.DataFrame(transactions_data)
+        df = pd.read_parquet(path)
 
         # Add a new column `total_amount`
-        df['total_amount'] = df['item_price'] * df['quantity']
+        df = H.add_total_amount(df)
 
         # Group df by `user_id` to calculate total amount spent
-        grouped_df = df.groupby('user_id', as_index=True).agg(
+        grouped_df = df.groupby('user_id', as_index=True, observed=True).agg(
             total_spent=pd.NamedAgg(column='total_amount', aggfunc='sum')
         )
         logging.info(grouped_df)
 
-        # Generate time series report for total sales per day
-        time_series = df.groupby(df['transaction_date'].dt.date).agg(
-            total_sales=pd.NamedAgg(column='total_amount', aggfunc='sum')
-        )
-        time_series.reset_index(inplace=True)
-        logging.info(time_series)
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        REPORTS_DIR = os.path.join(BASE_DIR, 'reports/time_series')
-        generate_time_series_report(time_series, REPORTS_DIR)
-
         # DATA ANALYSIS
-        df_top = df.copy()
-        top_3_categories = H.top_categories(df_top, top_n=3)
+        top_3_categories = H.top_categories(df, top_n=3)
         logging.info("Top 3 Categories Based on Total Sales:")
         logging.info(top_3_categories)
 
@@ -141,27 +236,26 @@ def etl_exercise():
         logging.info(user_segments[['user_id', 'segment']])
 
         # Retention analysis
-        df_retention_analysis = df.copy()
-        cohort_retention = H.cohort_retention_analysis(df_retention_analysis, time_period='M')
+        cohort_retention = H.cohort_retention_analysis(df, time_period='M')
         logging.info("\nCohort retention analysis:")
         logging.info(cohort_retention)
 
-        return df.to_dict()
-
     @task
-    def save_to_postgres(transactions_data: dict):
+    def save_to_postgres(path: str, run_id=None):
         """
         Saves the transaction data to a PostgreSQL database.
 
-        This function takes the transformed transaction data and inserts it into a PostgreSQL 
-        database table. It uses the PostgresHook to interact with the database and supports 
-        appending data to the specified table.
+        This function takes the cleansed transaction data, adds the `total_amount` column and inserts
+        it into a PostgreSQL database table. It uses the PostgresHook to interact with the database and appends the
+        data to the specified table through a single COPY statement. Rows are tagged with the run that loaded
+        them, and rows previously loaded by the same run are replaced, so retries don't duplicate them.
 
         Parameters
         ----------
-        transactions_data : dict
-            A dictionary containing the transaction data, which could be raw, cleansed, or 
-            transformed, depending on the task.
+        path : str
+            The path of the Parquet file containing the cleansed transaction data.
+        run_id : str
+            The identifier of the current DAG run, injected by Airflow.
 
         Returns
         -------
@@ -169,20 +263,127 @@ def etl_exercise():
 
         Raises
         ------
+        ValueError
+            If the `quantity` column doesn't have an integer type, which the COPY would reject.
         Exception
             If there is an error during the data insertion process, an exception is raised.
         """
-        df = pd.DataFrame(transactions_data)
+        df = pd.read_parquet(path)
+
+        # COPY rejects values like `4.0` for the integer `quantity` column
+        if not pd.api.types.is_integer_dtype(df['quantity']):
+            raise ValueError(f"Expected an integer 'quantity' column to load, got {df['quantity'].dtype}")
+
+        # Add a new column `total_amount`
+        df = H.add_total_amount(df)
+
+        # Tag the rows with the run loading them
+        df['run_id'] = run_id
+
         # Initialize the PostgresHook to get the connection
         pg_hook = PostgresHook(postgres_conn_id="postgres_conn")
         engine = pg_hook.get_sqlalchemy_engine()
 
+        # Create the table from the DataFrame schema if it doesn't exist yet, COPY needs it in place.
+        # Amounts are only narrowed in memory, they are stored as double precision
+        df.head(0).to_sql(
+            'transactions', engine, if_exists='append', index=False,
+            dtype={'item_price': Float(precision=53), 'total_amount': Float(precision=53)}
+        )
+        migrate_transactions_table(pg_hook)
+
+        # Stream the rows as an in-memory CSV buffer, and release the DataFrame once it's
+        # serialized so both aren't held in memory during the COPY
+        columns = ', '.join(df.columns)
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+        del df
+
+        conn = pg_hook.get_conn()
         try:
-            df.to_sql('transactions', engine, if_exists='append', index=False)
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM transactions WHERE run_id = %s", (run_id,))
+                cursor.copy_expert(
+                    f"COPY transactions ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')",
+                    buffer
+                )
+            conn.commit()
             logging.info("Data successfully inserted into the 'transactions' table.")
         except IntegrityError:
+            conn.rollback()
             logging.info("Data already added, check scheduling configuration!")
+        finally:
+            conn.close()
+
+    @task
+    def report_time_series(ds=None, run_id=None):
+        """
+        Generates the time series report of total sales per day from the PostgreSQL database.
+
+        This function pushes the daily aggregation down to the database, so only one row per day
+        is fetched to build the plot instead of every transaction loaded by the current run.
+
+        Parameters
+        ----------
+        run_id : str
+            The identifier of the current DAG run, injected by Airflow and used to select the
+            rows loaded by this run.
+        ds : str
+            The logical date of the current DAG run, injected by Airflow and used to name the
+            report, so concurrent runs don't overwrite each other's plot.
+
+        Returns
+        -------
+        None
+        """
+        pg_hook = PostgresHook(postgres_conn_id="postgres_conn")
+        time_series = pg_hook.get_pandas_df(
+            """
+            SELECT transaction_date::date AS transaction_date, SUM(total_amount::float8) AS total_sales
+            FROM transactions
+            WHERE run_id = %(run_id)s
+            GROUP BY 1
+            ORDER BY 1
+            """,
+            parameters={'run_id': run_id}
+        )
+        logging.info(time_series)
 
-    save_to_postgres(transform_data(cleansing_data(extract())))
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        REPORTS_DIR = os.path.join(BASE_DIR, 'reports/time_series')
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        generate_time_series_report(time_series, os.path.join(REPORTS_DIR, f'{ds}.png'))
+
+    @task
+    def cleanup_staging(run_id=None):
+        """
+        Removes the staged files of the current DAG run once every other task has succeeded.
+
+        Runs that fail keep their staged files, so clearing the failed tasks reuses them. This
+        function also sweeps the folders of those runs once they are older than STAGING_RETENTION.
+
+        Parameters
+        ----------
+        run_id : str
+            The identifier of the current DAG run, injected by Airflow.
+
+        Returns
+        -------
+        None
+        """
+        shutil.rmtree(os.path.join(STAGING_DIR, run_id), ignore_errors=True)
+
+        cutoff = datetime.now().timestamp() - STAGING_RETENTION.total_seconds()
+        for entry in os.scandir(STAGING_DIR):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                logging.info(f"Removing stale staged files at {entry.path}")
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    # Analytics and loading both read the cleansed data, so they run in parallel
+    cleansed_data = cleansing_data(extract())
+    analysis = transform_data(cleansed_data)
+    report = save_to_postgres(cleansed_data) >> report_time_series()
+    [analysis, report] >> cleanup_staging()
 
 etl_exercise_dag = etl_exercise()
\ No newline at end of file
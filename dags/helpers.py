@@ -1,41 +1,81 @@
 
-from typing import Union
+from typing import List, Optional, Union
+import numpy as np
 import pandas as pd
-from scipy.stats import zscore
 
-def remove_outliers_zscore(df: pd.DataFrame, column: str, threshold: Union[int, float] = 3) -> pd.DataFrame:
+def remove_outliers_zscore(df: pd.DataFrame, columns: Union[str, List[str]], threshold: Union[int, float] = 3,
+                           where: Optional[np.ndarray] = None) -> pd.DataFrame:
     """
-    Remove outliers from a specified column in a DataFrame using the Z-Score method.
+    Remove outliers from the specified columns in a DataFrame using the Z-Score method.
 
     The Z-Score method identifies outliers as values whose Z-Score exceeds a specified threshold. 
     The Z-Score is calculated as:
         Z = (X - mean) / std
-    Values with |Z| > threshold are considered outliers.
+    Values with |Z| > threshold are considered outliers. When several columns are given, the
+    Z-Scores of all of them are computed over the same rows and a row is removed if it is an
+    outlier in any column, so the DataFrame is filtered only once.
 
     Parameters:
     ----------
     df : pandas.DataFrame
         The input DataFrame containing the data.
-    column : str
-        The name of the column from which to detect and remove outliers.
+    columns : str or list of str
+        The name of the column, or columns, from which to detect and remove outliers.
     threshold : int or float, optional
         The Z-Score threshold for defining outliers (default is 3).
+    where : numpy.ndarray, optional
+        A boolean mask restricting the rows used to compute the mean and standard deviation.
+        Rows outside of it are removed as well (default is all rows).
+
+    Returns:
+    -------
+    pandas.DataFrame
+        A DataFrame with outliers removed for the specified columns.
+    """
+    if isinstance(columns, str):
+        columns = [columns]
+
+    if where is None:
+        where = np.ones(len(df), dtype=bool)
+
+    mask = where.copy()
+    for column in columns:
+        # Stay in float32 for float32 columns, so the whole comparison runs on the narrow dtype
+        values = df[column].to_numpy(copy=False)
+        dtype = np.result_type(values.dtype, np.float32)
+        mean = dtype.type(np.mean(values, where=where, dtype=dtype))
+        std = dtype.type(np.std(values, where=where, dtype=dtype))
+        mask &= np.abs(values - mean) <= threshold * std
+
+    return df if mask.all() else df[mask]
+
+
+def add_total_amount(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the `total_amount` column to a DataFrame of transactions, as `item_price` multiplied
+    by `quantity`. The product is computed in a single float32 pass, like `item_price`.
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        The input DataFrame containing transaction data. It must include the 'item_price'
+        and 'quantity' columns.
 
     Returns:
     -------
     pandas.DataFrame
-        A DataFrame with outliers removed for the specified column.
+        The same DataFrame, with the 'total_amount' (float32) column added.
     """
-    z_scores = zscore(df[column])
-    return df[abs(z_scores) <= threshold]
+    df['total_amount'] = np.multiply(df['item_price'].to_numpy(), df['quantity'].to_numpy(), dtype=np.float32)
+    return df
 
 
 def top_categories(data: pd.DataFrame, top_n: int = 3) -> pd.DataFrame:
     """
     Identifies the top N item categories based on total sales amount.
     The function calculates total sales for each category by multiplying
-    `item_price` by `quantity`, sorts the categories by total sales in descending 
-    order, and returns the top N categories with the highest total sales.
+    `item_price` by `quantity`, selects the categories with the largest total sales
+    (a partial sort) and returns them in descending order.
 
     Parameters:
     ----------
@@ -54,12 +94,10 @@ def top_categories(data: pd.DataFrame, top_n: int = 3) -> pd.DataFrame:
         - 'item_category' (str): The category of the item.
         - 'total_amount' (float): The total sales amount for the category.
     """
-    category_sales = data.groupby('item_category')['total_amount'].sum().reset_index()
-    top_categories = category_sales.sort_values(by='total_amount', ascending=False).head(top_n)
-    
-    return top_categories
+    category_sales = data.groupby('item_category', observed=True)['total_amount'].sum()
+    top_categories = category_sales.nlargest(top_n).reset_index()
 
-import numpy as np
+    return top_categories
 
 def customer_segmentation(data: pd.DataFrame) -> pd.DataFrame:
     """
@@ -83,7 +121,7 @@ def customer_segmentation(data: pd.DataFrame) -> pd.DataFrame:
         medium_spenders, or high_spenders) for each user. The returned DataFrame will have the following columns:
         - 'user_id' (int or str): The unique identifier for each user.
         - 'total_amount' (float): The total amount spent by the user.
-        - 'segment' (str): The segment the user belongs to ('low_spenders', 'medium_spenders', 'high_spenders').
+        - 'segment' (category): The segment the user belongs to ('low_spenders', 'medium_spenders', 'high_spenders').
     
     Notes:
     ------
@@ -93,27 +131,20 @@ def customer_segmentation(data: pd.DataFrame) -> pd.DataFrame:
         - High spenders: Users with spending above the 66th percentile.
     """
     # Calculate total spending per user
-    user_spending = data.groupby('user_id')['total_amount'].sum().reset_index()
+    user_spending = data.groupby('user_id', observed=True)['total_amount'].sum().reset_index()
     
     # Define thresholds based on total spending
     low_threshold = user_spending['total_amount'].quantile(0.33)
     high_threshold = user_spending['total_amount'].quantile(0.66)
     
-    # Segment users based on their total spending
-    conditions = [
-        (user_spending['total_amount'] <= low_threshold),  # low_spenders
-        (user_spending['total_amount'] > low_threshold) & (user_spending['total_amount'] <= high_threshold),  # medium_spenders
-        (user_spending['total_amount'] > high_threshold)  # high_spenders
-    ]
+    # Segment users based on their total spending, the number of thresholds strictly below each
+    # total is its segment code: 0 (low_spenders), 1 (medium_spenders) or 2 (high_spenders)
+    codes = np.searchsorted([low_threshold, high_threshold], user_spending['total_amount'].to_numpy(), side='left')
     choices = ['low_spenders', 'medium_spenders', 'high_spenders']
-    
-    user_spending['segment'] = np.select(conditions, choices, default='low_spenders')
-
-    return user_spending
 
-import pandas as pd
+    user_spending['segment'] = pd.Categorical.from_codes(codes, categories=choices)
 
-import pandas as pd
+    return user_spending
 
 def cohort_retention_analysis(data: pd.DataFrame, time_period: str = 'M') -> pd.DataFrame:
     """
@@ -135,7 +166,7 @@ def cohort_retention_analysis(data: pd.DataFrame, time_period: str = 'M') -> pd.
     Returns:
     -------
     pandas.DataFrame
-        A DataFrame containing cohort retention analysis with the following columns:
+        A new DataFrame (the input data is left untouched) containing cohort retention analysis with the following columns:
         - 'cohort': The cohort of users based on their first purchase month.
         - 'period': The subsequent time period after the first purchase.
         - 'cohort_size': The number of users in the cohort.
@@ -148,29 +179,62 @@ def cohort_retention_analysis(data: pd.DataFrame, time_period: str = 'M') -> pd.
     - The retention rate is calculated as:
         - Retention Rate = (retained_users / cohort_size) * 100
     """
-    # Ensure transaction_date is in datetime format
-    data['transaction_date'] = pd.to_datetime(data['transaction_date'])
-
-    # Create a 'cohort' column by finding the first transaction period for each user
-    data['cohort'] = data.groupby('user_id')['transaction_date'].transform('min').dt.to_period(time_period)
-
-    # Create a 'period' column to represent the period since the user's first transaction
-    data['period'] = (data['transaction_date'].dt.to_period(time_period) - data['cohort']).apply(lambda x: x.n)
-    
-    # Count the number of users in each cohort and period
-    cohort_data = data.groupby(['cohort', 'period', 'user_id']).size().reset_index(name='purchase_count')
-
-    # Get cohort size (number of unique users in each cohort)
-    cohort_size = cohort_data.groupby('cohort')['user_id'].nunique().reset_index(name='cohort_size')
+    # Ensure transaction_date is in datetime format, kept local so the input DataFrame is not modified.
+    # Columns that are already datetime64 (e.g. read from Parquet) are used as they are
+    transaction_date = data['transaction_date']
+    if not pd.api.types.is_datetime64_any_dtype(transaction_date):
+        transaction_date = pd.to_datetime(transaction_date, format='ISO8601', cache=True)
+
+    # Find the first transaction period of each user once, and look it up by user code
+    # to get the cohort of each transaction
+    user_codes, users = pd.factorize(data['user_id'])
+
+    # Transactions without user_id (code -1) don't belong to any cohort, they are left out
+    # like a groupby on user_id would do
+    has_user = user_codes >= 0
+    if not has_user.all():
+        user_codes = user_codes[has_user]
+        transaction_date = transaction_date[has_user]
+
+    first_dates = transaction_date.groupby(user_codes).min().reindex(np.arange(len(users)))
+    cohorts = first_dates.dt.to_period(time_period).array.take(user_codes)
+
+    # Compute the period since the user's first transaction, subtracting the integer
+    # period ordinals instead of Period objects row by row
+    periods = transaction_date.dt.to_period(time_period).array.asi8 - cohorts.asi8
+
+    # Sort the rows once by cohort, period and user, working on integer keys
+    order = np.lexsort((user_codes, periods, cohorts.asi8))
+    cohort_keys = cohorts.asi8[order]
+    period_keys = periods[order]
+    user_keys = user_codes[order]
+
+    # Flag where each (cohort, period) segment starts, and the first row of every user inside it
+    new_segment = np.ones(len(order), dtype=bool)
+    new_segment[1:] = (cohort_keys[1:] != cohort_keys[:-1]) | (period_keys[1:] != period_keys[:-1])
+    new_user = new_segment.copy()
+    new_user[1:] |= user_keys[1:] != user_keys[:-1]
+    segment_starts = np.flatnonzero(new_segment)
 
     # Get the number of retained users in each period for each cohort
-    retained_users = cohort_data.groupby(['cohort', 'period'])['user_id'].nunique().reset_index(name='retained_users')
-
-    # Merge cohort size with retained users
-    retention = pd.merge(retained_users, cohort_size, on='cohort')
-
-    # Calculate retention rate
-    retention['retention_rate'] = (retention['retained_users'] / retention['cohort_size']) * 100
+    retention = pd.DataFrame({
+        'cohort': cohorts.take(order[segment_starts]),
+        'period': period_keys[segment_starts],
+        'retained_users': np.add.reduceat(new_user, segment_starts, dtype=np.int64)
+    })
+
+    # Get cohort size (number of unique users in each cohort), every user belongs to a single cohort
+    _, user_rows = np.unique(user_keys, return_index=True)
+    _, cohort_rows, cohort_counts = np.unique(cohort_keys[user_rows], return_index=True, return_counts=True)
+    cohort_size = pd.Series(cohort_counts, index=cohorts.take(order[user_rows[cohort_rows]]))
+
+    # Look up the cohort size of each row of retained users
+    retention['cohort_size'] = retention['cohort'].map(cohort_size)
+
+    # Calculate retention rate, scaling the quotient in place
+    retention_rate = np.divide(retention['retained_users'].to_numpy(), retention['cohort_size'].to_numpy(dtype=np.float64))
+    np.multiply(retention_rate, 100, out=retention_rate)
+    retention['retention_rate'] = retention_rate
 
     return retention
 
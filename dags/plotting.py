@@ -1,7 +1,12 @@
 from airflow.decorators import task
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend, workers only render to files
 import matplotlib.pyplot as plt
 
+# Upper bound of points drawn in a plot, longer series are down-sampled
+MAX_PLOT_POINTS = 2000
+
 def generate_time_series_report(data: pd.DataFrame, plot_path: str) -> str:
     """
     Generate the plot of a time series report showing total sales per day.
@@ -18,18 +23,21 @@ def generate_time_series_report(data: pd.DataFrame, plot_path: str) -> str:
     str
         The file paths where the report and plot were saved.
     """
+    # Down-sample very long series to avoid drawing millions of markers
+    data = data.iloc[::max(1, -(-len(data) // MAX_PLOT_POINTS))]
+
     # Plot the time series data
-    plt.figure(figsize=(10, 6))
-    plt.plot(data['transaction_date'], data['total_sales'], marker='o', color='b', label='Total Sales')
-    plt.title('Total Sales per Day')
-    plt.xlabel('Date')
-    plt.ylabel('Total Sales Amount')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.legend()
-    
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.plot(data['transaction_date'], data['total_sales'], marker='o', color='b', label='Total Sales')
+    ax.set_title('Total Sales per Day')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Total Sales Amount')
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid(True)
+    ax.legend()
+
     # Save the plot to the specified file path
-    plt.savefig(plot_path)
-    plt.close()  # Close the plot to free memory
+    fig.savefig(plot_path, dpi=100)
+    plt.close(fig)  # Close the plot to free memory
 
     return f"Plot saved at: {plot_path}"